@@ -1,36 +1,205 @@
 import os
+import functools
+import gc
+import shutil
 import yt_dlp
-import whisper
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel, decode_audio
+import av
+from av.codec.hwaccel import HWAccel, hwdevices_available
 import cv2
 import numpy as np
-from jinja2 import Template
+from jinja2 import Environment
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Report template, compiled once at import rather than on every generate_html call
+HTML_TEMPLATE = Environment(autoescape=True, auto_reload=False).from_string('''
+<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <title>{{ title }}</title>
+    <style>
+        body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
+        .section { margin-bottom: 30px; border-bottom: 1px solid #ddd; padding-bottom: 20px; }
+        .frames { display: block; } /* Change to block for one image per row */
+        .frames img { max-width: 100%; margin-bottom: 10px; } /* Adjust margin for spacing */                
+    </style>
+</head>
+<body>
+    <h1>{{ title }}</h1>
+    <p><a href="{{ youtube_url }}">{{ youtube_url }}</a></p>
+    {% for section in sections %}
+    <div class="section">
+        <h2>Section {{ loop.index }}</h2>
+        <p><a href="{{ youtube_url }}&t={{ section.start_time | round(2) }}s">Time Range: {{ section.start_time | round(2) }} s - {{ section.end_time | round(2) }} s</a></p>                
+        <p>{{ section.text }}</p>
+        <div class="frames">
+            {% for frame in section.frames %}
+            <img src="{{ current_directory }}/{{ frame }}" alt="Frame at {{ frame }}">
+            {% endfor %}
+        </div>
+    </div>
+    {% endfor %}
+</body>
+</html>
+''')
+
+
+# Whisper pipelines shared by all processors, keyed by (model name, device)
+_whisper_models = {}
+# Set once transcription on the GPU has failed, so later processors use the CPU
+_whisper_gpu_failed = False
+
+
+def _get_whisper(name, device):
+    """
+    Load a Whisper model once per process so all processors share its weights
+    
+    :param name: Whisper model size, or path to a converted CTranslate2 model
+    :param device: "cuda" for GPU inference (FP16, or the saved type of a converted model),
+        "cpu" for int8 inference
+    :return: Batched faster-whisper inference pipeline
+    """
+    if (name, device) not in _whisper_models:
+        # CTranslate2 backend, wrapped for batched inference over VAD-chunked audio windows
+        if device == "cpu":
+            compute_type = "int8"
+        elif os.path.isdir(name):
+            # Pre-converted model: keep the quantization it was saved with
+            compute_type = "default"
+        else:
+            compute_type = "float16"
+        _whisper_models[name, device] = BatchedInferencePipeline(
+            model=WhisperModel(name, device=device, compute_type=compute_type)
+        )
+    return _whisper_models[name, device]
+
+
+def _disable_whisper_gpu(name):
+    """
+    Evict a GPU Whisper pipeline that failed and use the CPU for the rest of the process
+    
+    :param name: Whisper model size, or path to a converted CTranslate2 model
+    """
+    global _whisper_gpu_failed
+    _whisper_gpu_failed = True
+    _whisper_models.pop((name, "cuda"), None)
 
 
 class YouTubeVideoProcessor:
-    def __init__(self, youtube_url):
+    def __init__(self, youtube_url, whisper_model="base"):
         """
         Initialize the video processor with a YouTube URL
         
         :param youtube_url: URL of the YouTube video
+        :param whisper_model: Whisper model size, or path to a converted CTranslate2 model
         """
-        # Download the YouTube video
-        self.video_path = self._download_video(youtube_url)
+        self.whisper_model_name = whisper_model
+
+        # yt-dlp options shared by the audio and video downloads
+        self._ydl_opts = {
+            'quiet': True,  # Suppress output during download
+            'concurrent_fragment_downloads': 16,  # Fetch DASH/HLS fragments in parallel
+        }
+        # Split plain HTTP downloads into parallel ranges when aria2c is installed
+        if shutil.which('aria2c'):
+            self._ydl_opts['external_downloader'] = {'default': 'aria2c'}
+            self._ydl_opts['external_downloader_args'] = {'aria2c': ['-x', '16', '-s', '16']}
+        
+        # Download the audio track for transcription; the video is only needed for frame
+        # extraction, so its download runs in the background while the audio is transcribed
+        self.audio_path = self._download_audio(youtube_url)
+        # A future (rather than a bare thread) hands back the video path and re-raises any
+        # download error to whoever waits on it; shutdown(wait=False) only stops the pool
+        # accepting work, the submitted download keeps running in the background
+        executor = ThreadPoolExecutor(max_workers=1)
+        self._video_download = executor.submit(self._download_video, youtube_url)
+        executor.shutdown(wait=False)
         
         # Create output directories
         os.makedirs('frames', exist_ok=True)
         os.makedirs('output', exist_ok=True)        
-        
-        # Initialize Whisper model 
-        self.whisper_model = whisper.load_model("base")
+
+    @functools.cached_property
+    def video_path(self):
+        """
+        Path of the downloaded video, waiting for the background download to finish
+        """
+        return self._video_download.result()
+
+    @property
+    def yt_title(self):
+        """
+        Title of the video, set by the background download once it finishes
+        """
+        self._video_download.result()
+        return self._yt_title
+
+    @functools.cached_property
+    def whisper_device(self):
+        """
+        Device for Whisper inference, the GPU when CTranslate2 can run FP16 on it
+        """
+        if _whisper_gpu_failed or ctranslate2.get_cuda_device_count() == 0:
+            return "cpu"
+        # FP16 needs tensor cores (compute capability 7.0+); older GPUs stay on the CPU
+        if "float16" not in ctranslate2.get_supported_compute_types("cuda"):
+            return "cpu"
+        return "cuda"
+
+    @functools.cached_property
+    def whisper_model(self):
+        """
+        Whisper model, loaded on first use (cached transcriptions never load it)
+        """
+        return _get_whisper(self.whisper_model_name, self.whisper_device)
+
+    def _download_audio(self, video_url):
+        ydl_opts = {
+            **self._ydl_opts,
+            'format': 'bestaudio/best',  # Only the audio is needed for transcription
+            'outtmpl': 'audio.%(ext)s',
+            'postprocessors': [{
+                'key': 'FFmpegExtractAudio',
+                'preferredcodec': 'wav',
+                'preferredquality': '192',
+            }],
+        }
+        audio_path = os.path.abspath('audio.wav')
+
+        if not os.path.exists(audio_path):
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                try:
+                    ydl.download([video_url])
+                except Exception as e:
+                    print("An error occurred while downloading the audio:", str(e))
+
+        print(f"Downloaded audio path: {audio_path}")
+        return audio_path
 
     def _download_video(self, video_url):
         ydl_opts = {
-            'format': 'best',  # Download the best quality
+            **self._ydl_opts,
+            # Audio is fetched separately, so prefer a video-only stream
+            'format': 'bestvideo[ext=mp4]/bestvideo/best',
             'outtmpl': 'downloaded_video.%(ext)s',  # Save as the video title
-            'quiet': True,  # Suppress output during download
+            'writeinfojson': True,  # Keep the metadata next to the video for later runs
         }
+
+        # Skip the metadata request when both the video and its info file are cached
+        info_file_path = 'downloaded_video.info.json'
+        if os.path.exists(info_file_path):
+            with open(info_file_path, 'r', encoding='utf-8') as f:
+                info_dict = json.load(f)
+            video_path = os.path.abspath(f"downloaded_video.{info_dict.get('ext', 'mp4')}")
+            if os.path.exists(video_path):
+                self._yt_title = info_dict.get('title', 'Unknown Title')
+                print(f"Downloaded file path: {video_path}")
+                return video_path
         
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
             # Extract video information
@@ -41,7 +210,7 @@ class YouTubeVideoProcessor:
                 output_file_path = f"downloaded_video.{video_extension}"
 
                 # Print the path of the downloaded file
-                self.yt_title = video_title
+                self._yt_title = video_title
                 video_path = os.path.abspath(output_file_path)
                 
                 if not os.path.exists(video_path):
@@ -52,12 +221,13 @@ class YouTubeVideoProcessor:
             except Exception as e:
                 print("An error occurred while downloading the video:", str(e))
 
-    def extract_text_and_frames(self, section_duration=60, frame_interval=70):
+    def extract_text_and_frames(self, section_duration=60, frame_interval=70, release_model=False):
         """
         Extract text and frames from the video
         
         :param section_duration: Duration of each text section in seconds
         :param frame_interval: Interval for extracting frames in seconds
+        :param release_model: Free the Whisper model once transcription is done
         :return: List of sections with text and frames
         """
         # Define the path for the transcription result
@@ -70,84 +240,206 @@ class YouTubeVideoProcessor:
                 result = json.load(f)  # Load the existing transcription
         else:
             print("Transcribing the video (may be time consuming) ...")
-            result = self.whisper_model.transcribe(self.video_path)
+            # Decode once to a 16 kHz mono float32 buffer; kept for later passes over the audio
+            self._audio = decode_audio(self.audio_path, sampling_rate=16000)
+            try:
+                result = self._transcribe(self._audio)
+            except RuntimeError as e:
+                if self.whisper_device != "cuda":
+                    raise
+                # Typically CUDA out of memory; retry with the int8 CPU model
+                print("Transcription on GPU failed, retrying on CPU:", str(e))
+                result = None
+            if result is None:
+                # Evict the GPU model outside the except block, where the traceback no
+                # longer keeps it alive, so its memory is freed before the CPU retry
+                _disable_whisper_gpu(self.whisper_model_name)
+                self.__dict__.pop('whisper_model', None)
+                gc.collect()
+                self.whisper_device = "cpu"
+                result = self._transcribe(self._audio)
 
             # Save the transcription result to disk
             with open(transcription_file_path, 'w', encoding='utf-8') as f:
                 json.dump(result, f, ensure_ascii=False, indent=4)
             print(f"Transcription saved to {transcription_file_path}")
 
-        # Process video for frames
-        video = cv2.VideoCapture(self.video_path)
-        fps = video.get(cv2.CAP_PROP_FPS)
+            if release_model:
+                self.release_whisper_model()
+
+        # Process video for frames; one container is kept open for all sections
+        container = self._open_video()
+        stream = container.streams.video[0]
+        stream.thread_type = "SLICE"
         
+        segments = result['segments']
+        ends = np.fromiter((segment['end'] for segment in segments), dtype=np.float64, count=len(segments))
+
         sections = []
-        current_section = {
-            'start_time': 0,
-            'text': '',
-            'frames': []
-        }
-        
-        for segment in result['segments']:
-            # Add text to current section
-            current_section['text'] += segment['text'] + ' '
-            
-            # Check if section is complete
-            if segment['end'] - current_section['start_time'] >= section_duration:
-                # Extract frames for this section
-                current_section['frames'] = self._extract_representative_frames(
-                    video, fps, 
-                    current_section['start_time'], 
-                    segment['end'], 
-                    frame_interval
-                )
-                
-                current_section['end_time'] = segment['end']
-                
-                sections.append(current_section)
-                
-                # Start a new section
-                current_section = {
-                    'start_time': segment['end'],
-                    'text': '',
-                    'frames': []
-                }
-        
-        # Process final section if not empty
-        if current_section['text']:
-            current_section['frames'] = self._extract_representative_frames(
-                video, fps, 
-                current_section['start_time'], 
-                video.get(cv2.CAP_PROP_FRAME_COUNT) / fps, 
-                frame_interval
+        section_timestamps = []
+        start_time, first = 0, 0
+        while first < len(segments):
+            # A section closes at the first segment ending section_duration past its start
+            last = max(int(np.searchsorted(ends, start_time + section_duration)), first)
+            seg_slice = segments[first:last + 1]
+
+            if last < len(segments):
+                end_time = frames_end_time = ends[last]
+            else:
+                # Final section: sample frames up to the end of the video
+                end_time = ends[-1]
+                frames_end_time = container.duration / av.time_base
+
+            sections.append({
+                'start_time': start_time,
+                'end_time': end_time,
+                # Build the text in one join over a list (join materializes generators first)
+                'text': ' '.join([segment['text'] for segment in seg_slice]),
+                'frames': [],
+            })
+            section_timestamps.append(np.arange(start_time, frames_end_time, frame_interval))
+
+            # Start a new section
+            start_time, first = end_time, last + 1
+
+        # Load the index of frames extracted by previous runs, dropping deleted files
+        frames_index_path = 'frames_index.json'
+        frames_index = {}
+        if os.path.exists(frames_index_path):
+            with open(frames_index_path, 'r', encoding='utf-8') as f:
+                frames_index = json.load(f)
+        frames_index = {t: path for t, path in frames_index.items() if os.path.exists(path)}
+
+        # Format every timestamp key once; it is used for both lookup and attachment
+        section_keys = [[f'{t:.2f}' for t in timestamps] for timestamps in section_timestamps]
+
+        # Extract the missing frames of all sections in one forward pass over the video
+        pending = {}
+        for timestamps, keys in zip(section_timestamps, section_keys):
+            for t, key in zip(timestamps, keys):
+                if key not in frames_index:
+                    pending[key] = t
+        if pending:
+            frames_index.update(
+                self._extract_representative_frames(container, stream, sorted(pending.values()))
             )
-            current_section['end_time'] = result['segments'][-1]['end']
-            sections.append(current_section)
-        
-        video.release()
+            with open(frames_index_path, 'w', encoding='utf-8') as f:
+                json.dump(frames_index, f, indent=4)
+        container.close()
+
+        # Attach frame paths to sections by timestamp
+        for section, keys in zip(sections, section_keys):
+            section['frames'] = [frames_index[key] for key in keys if key in frames_index]
+
         return sections
     
-    def _extract_representative_frames(self, video, fps, start_time, end_time, interval):
+    def release_whisper_model(self):
         """
-        Extract representative frames from a video segment
+        Free the Whisper model and decoded audio so their memory is available for frame extraction
+        """
+        # Drop both this processor's reference and the process-wide shared copy
+        self.__dict__.pop('whisper_model', None)
+        self.__dict__.pop('_audio', None)
+        _whisper_models.clear()
+        gc.collect()
+
+    def _transcribe(self, audio):
+        """
+        Transcribe audio with the Whisper model
+        
+        :param audio: 16 kHz mono float32 audio
+        :return: Transcription result with a list of segments
+        """
+        # The batched pipeline defaults to one segment per ~30 s VAD chunk; keep Whisper's
+        # own segment timestamps so sections and their links stay close to section_duration
+        segments, info = self.whisper_model.transcribe(
+            audio, vad_filter=True, beam_size=1, batch_size=16, without_timestamps=False
+        )
+        # Segments are yielded lazily; materialize them in the openai-whisper result layout
+        return {'segments': [{'text': s.text, 'start': s.start, 'end': s.end} for s in segments]}
+
+    def _open_video(self):
+        """
+        Open the downloaded video, decoding on the GPU / media engine when available
+        
+        :return: PyAV input container
+        """
+        available = hwdevices_available()
+        for device_type in ('cuda', 'videotoolbox', 'vaapi', 'd3d11va'):
+            if device_type in available:
+                # Falls back to software decoding if the codec is unsupported by the device
+                hwaccel = HWAccel(device_type=device_type, allow_software_fallback=True)
+                try:
+                    return av.open(self.video_path, hwaccel=hwaccel)
+                except Exception as e:
+                    # Device types are those compiled into FFmpeg, not necessarily present
+                    print(f"Hardware decoding with {device_type} unavailable:", str(e))
+        return av.open(self.video_path)
+
+    def _extract_representative_frames(self, container, stream, timestamps, seek_threshold=10):
+        """
+        Extract representative frames from the video
         
-        :param video: OpenCV video capture object
-        :param fps: Frames per second
-        :param start_time: Start time of segment
-        :param end_time: End time of segment
-        :param interval: Interval for frame extraction
-        :return: List of frame paths
-        """
-        frames = []
-        for t in np.arange(start_time, end_time, interval):
-            video.set(cv2.CAP_PROP_POS_MSEC, t * 1000)
-            ret, frame = video.read()
-            if ret:
-                frame_path = f'frames/frame_{t:.2f}.jpg'
-                cv2.imwrite(frame_path, frame)
-                frames.append(frame_path)
+        :param container: PyAV input container of the video
+        :param stream: Video stream of the container
+        :param timestamps: Sorted times in seconds to extract frames at
+        :param seek_threshold: Gap in seconds beyond which seeking is cheaper than decoding forward
+        :return: Dict mapping each formatted timestamp to its frame path
+        """
+        frames = {}
+        # Format keys and paths up front so the loop below only drives the decoder
+        keys = [f'{t:.2f}' for t in timestamps]
+        paths = [f'frames/frame_{key}.jpg' for key in keys]
+        # Work in integer stream timestamps: no float drift, and no Fraction
+        # arithmetic for every decoded frame
+        time_base = float(stream.time_base)
+        start_pts = stream.start_time or 0
+        target_pts = start_pts + np.round(np.asarray(timestamps, dtype=np.float64) / time_base).astype(np.int64)
+        seek_threshold_pts = int(seek_threshold / time_base)
+        decoded = None
+        position = start_pts
+        # JPEG encoding releases the GIL, so it overlaps with decoding the next frame
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = []
+            for key, frame_path, pts in zip(keys, paths, target_pts.tolist()):
+                # Decode the video in a single forward pass, only jumping to the keyframe
+                # before the target when the gap is too long to be worth decoding through
+                if decoded is None or pts - position > seek_threshold_pts:
+                    container.seek(pts, stream=stream, any_frame=False, backward=True)
+                    decoded = container.decode(stream)
+                for frame in decoded:
+                    frame_pts = frame.pts
+                    if frame_pts is None:
+                        continue
+                    position = frame_pts
+                    if position >= pts:
+                        # The report shows frames at most 800 px wide, so downscale during the
+                        # BGR conversion; encode cost scales with the pixel count
+                        width, height = frame.width, frame.height
+                        if width > 800:
+                            width, height = 800, height * 800 // width
+                        # Only sampled frames are converted; to_ndarray returns a fresh array,
+                        # so no copy is needed before handing it off
+                        image = frame.to_ndarray(format='bgr24', width=width, height=height, interpolation='AREA')
+                        futures.append(executor.submit(self._write_frame, frame_path, image))
+                        frames[key] = frame_path
+                        break
+            for f in futures:
+                f.result()
         return frames
     
+    def _write_frame(self, frame_path, frame):
+        """
+        Encode a frame as JPEG in memory and write the bytes in one call
+        
+        :param frame_path: Output path of the JPEG file
+        :param frame: BGR frame as a NumPy array
+        """
+        ok, buf = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+        if ok:
+            with open(frame_path, 'wb') as f:
+                f.write(buf.tobytes())
+
     def generate_html(self, youtube_url, sections):
         """
         Generate HTML report of video sections
@@ -158,64 +450,35 @@ class YouTubeVideoProcessor:
         .frames img { max-width: 200px; margin-right: 10px; }        
         
         """
-        html_template = Template('''
-        <!DOCTYPE html>
-        <html lang="en">
-        <head>
-            <meta charset="UTF-8">
-            <title>{{ title }}</title>
-            <style>
-                body { font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; }
-                .section { margin-bottom: 30px; border-bottom: 1px solid #ddd; padding-bottom: 20px; }
-                .frames { display: block; } /* Change to block for one image per row */
-                .frames img { max-width: 100%; margin-bottom: 10px; } /* Adjust margin for spacing */                
-            </style>
-        </head>
-        <body>
-            <h1>{{ title }}</h1>
-            <p><a href="{{ youtube_url }}">{{ youtube_url }}</a></p>
-            {% for section in sections %}
-            <div class="section">
-                <h2>Section {{ loop.index }}</h2>
-                <p><a href="{{ youtube_url }}&t={{ section.start_time | round(2) }}s">Time Range: {{ section.start_time | round(2) }} s - {{ section.end_time | round(2) }} s</a></p>                
-                <p>{{ section.text }}</p>
-                <div class="frames">
-                    {% for frame in section.frames %}
-                    <img src="{{ current_directory }}/{{ frame }}" alt="Frame at {{ frame }}">
-                    {% endfor %}
-                </div>
-            </div>
-            {% endfor %}
-        </body>
-        </html>
-        ''')
         current_directory = os.getcwd()
         
-        rendered_html = html_template.render(
-            title=f'Vid2Doc: {self.yt_title}', 
-            sections=sections,
-            current_directory=current_directory,
-            youtube_url=youtube_url,
-        )
-        
+        # Stream the rendered HTML to disk instead of building the whole document in memory
         with open('output/vid2doc.html', 'w', encoding='utf-8') as f:
-            f.write(rendered_html)
+            HTML_TEMPLATE.stream(
+                title=f'Vid2Doc: {self.yt_title}', 
+                sections=sections,
+                current_directory=current_directory,
+                youtube_url=youtube_url,
+            ).dump(f)
     
     def cleanup(self):
         """
-        Clean up temporary video file
+        Clean up temporary audio and video files
         """
+        os.remove(self.audio_path)
         os.remove(self.video_path)
 
-def main(youtube_url):
+def main(youtube_url, whisper_model="base"):
     """
     Main function to process YouTube video
     
     :param youtube_url: URL of the YouTube video to process
+    :param whisper_model: Whisper model size, or path to a converted CTranslate2 model
     """
-    processor = YouTubeVideoProcessor(youtube_url)
+    processor = YouTubeVideoProcessor(youtube_url, whisper_model)
     try:
-        sections = processor.extract_text_and_frames()
+        # A single video is processed, so the model is not needed after transcription
+        sections = processor.extract_text_and_frames(release_model=True)
         processor.generate_html(youtube_url, sections)
         print("Vid2Doc complete. Check output/vid2doc.html")
     finally:
@@ -226,6 +489,8 @@ if __name__ == "__main__":
     # youtube_url = "https://www.youtube.com/watch?v=Mn_9W1nCFLo"
     parser = argparse.ArgumentParser(description="Process a YouTube URL.")
     parser.add_argument("--youtube_url", type=str, help="The URL of the YouTube video")
+    parser.add_argument("--whisper_model", type=str, default="base",
+                        help="Whisper model size, or path to a converted CTranslate2 model")
 
     args = parser.parse_args()
-    main(args.youtube_url)
+    main(args.youtube_url, args.whisper_model)